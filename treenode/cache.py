@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+"""
+TreeNode Cache Module
+
+"""
+
+from time import time_ns
+from django.core.cache import caches
+from django.db import transaction
+
+
+treenode_cache = caches['treenode']
+
+
+def get_cache_version(model):
+    """Get the version of the cached results of the model tree"""
+
+    # The version never expires: a lost one would bring back the entries
+    # stored under it. A new one starts from the clock for the same reason.
+    return treenode_cache.get_or_set(
+        f"{model._meta.label}_tree_version", time_ns, timeout=None)
+
+
+def update_cache_version(model, using=None):
+    """Invalidate the cached results of the model tree"""
+
+    # Bumped once the changes are committed: a result read from the old
+    # tree by another process must not be cached under the new version.
+    transaction.on_commit(lambda: _incr_cache_version(model), using=using)
+
+
+def _incr_cache_version(model):
+    key = f"{model._meta.label}_tree_version"
+    try:
+        treenode_cache.incr(key)
+    except ValueError:
+        treenode_cache.set(key, time_ns(), timeout=None)
+
+# End
@@ -6,3 +6,9 @@ if django.VERSION >= (3, 0):
     from django.utils.encoding import force_str
 else:
     from django.utils.encoding import force_text as force_str
+
+try:
+    # Optional: faster bulk updates on MySQL, MariaDB and SQLite < 3.33
+    from fast_update.query import FastUpdateQuerySet
+except ImportError:
+    FastUpdateQuerySet = None
@@ -7,6 +7,7 @@ Model Factory Module
 import sys
 from django.db import models
 from django.db.models.base import ModelBase
+from .managers import ClosureModelManager
 
 
 class TreeFactory(ModelBase):
@@ -36,28 +37,35 @@ class TreeFactory(ModelBase):
 
         meta_dict = dict(
             app_label=cls._meta.app_label,
+            # The unique constraint already indexes (parent, child)
             unique_together=(('parent', 'child',),),
             indexes=[
-                models.Index(fields=['parent', 'child']),
-                models.Index(fields=['parent']),
-                models.Index(fields=['child']),
+                # Both lookup directions are covered: the third column is
+                # read from the index, not from the table
+                models.Index(fields=['parent', 'depth', 'child']),
+                models.Index(fields=['child', 'depth', 'parent']),
             ]
         )
 
         fields = dict(
+            # Both columns lead one of the indexes above, so the foreign
+            # keys don't get single-column indexes of their own
             parent=models.ForeignKey(
                 cls._meta.object_name,
                 on_delete=models.CASCADE,
                 related_name='children_set',
+                db_index=False,
             ),
 
             child=models.ForeignKey(
                 cls._meta.object_name,
                 on_delete=models.CASCADE,
                 related_name='parents_set',
+                db_index=False,
             ),
 
-            depth=models.IntegerField(),
+            depth=models.PositiveSmallIntegerField(),
+            objects=ClosureModelManager(),
             __module__=cls._meta.app_label,
             Meta=type('Meta', (object,), meta_dict),
         )
@@ -65,4 +73,6 @@ class TreeFactory(ModelBase):
         model = type(model_name, (models.Model,), fields)
 
         setattr(cls, 'closure_model', model)
+        # Plain class attribute used by the node methods
+        setattr(cls, '_closure_model', model)
         return model
@@ -12,19 +12,21 @@ class TreeNodeForm(forms.ModelForm):
 
         if 'tn_parent' not in self.fields:
             return
-        exclude_pks = []
         obj = self.instance
-        if obj.pk:
-            exclude_pks += [obj.pk]
-            # tn_get_descendants_pks changed to get_descendants_pks()
-            # exclude_pks += split_pks(obj.get_descendants_pks())
-            exclude_pks += obj.get_descendants_pks()
 
         # Cheaged to "legal" call
         manager = obj._meta.model.objects
+        queryset = manager.prefetch_related('tn_children')
 
-        self.fields['tn_parent'].queryset = manager.prefetch_related(
-            'tn_children').exclude(pk__in=exclude_pks)
+        if obj.pk:
+            # The node and its descendants are excluded by a subquery on the
+            # Closure Table (the node is its own descendant at depth 0), so
+            # their pks are never loaded.
+            queryset = queryset.exclude(
+                pk__in=obj._closure_model.objects.filter(
+                    parent_id=obj.pk).values('child'))
+
+        self.fields['tn_parent'].queryset = queryset
 
     class Meta:
         widgets = {
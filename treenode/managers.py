@@ -4,8 +4,66 @@ TreeNode Managers Module
 
 """
 
-from django.db import models
+from itertools import groupby, islice
+from operator import itemgetter
+from struct import pack
+from django.db import models, connections, router, transaction
 from django.db.models import Case, When, Value
+from .cache import treenode_cache, get_cache_version, update_cache_version
+from .compat import FastUpdateQuerySet
+
+
+def update_priorities(model, using, pairs, batch_size=5000):
+    """
+    Write (pk, tn_priority) pairs with one set-based UPDATE per batch.
+
+    On PostgreSQL and SQLite 3.33+ the table is joined to a VALUES list
+    instead of the CASE WHEN statement built by bulk_update(). MySQL and
+    older SQLite use django-fast-update when it is installed, the other
+    backends bulk_update(): fast_update() would run one UPDATE per row.
+    """
+
+    connection = connections[using]
+    opts = model._meta
+    vendor = connection.vendor
+
+    if not (vendor == 'postgresql' or (
+            vendor == 'sqlite' and
+            connection.Database.sqlite_version_info >= (3, 33))):
+        objs = [model(pk=pk, tn_priority=priority) for pk, priority in pairs]
+        if FastUpdateQuerySet is not None and vendor in ('mysql', 'sqlite'):
+            FastUpdateQuerySet(model, using=using).fast_update(
+                objs, ('tn_priority', ))
+        else:
+            model._base_manager.db_manager(using).bulk_update(
+                objs, ('tn_priority', ), batch_size=batch_size)
+        return
+
+    fields = [opts.pk, opts.get_field('tn_priority')]
+    max_batch_size = connection.ops.bulk_batch_size(
+        fields, range(batch_size))
+    batch_size = min(batch_size, max(max_batch_size, 1))
+    qn = connection.ops.quote_name
+    sql = """
+        WITH v (pk, priority) AS (VALUES {{values}})
+        UPDATE {table} SET {priority} = v.priority
+        FROM v WHERE {table}.{pk} = v.pk
+    """.format(
+        table=qn(opts.db_table),
+        pk=qn(opts.pk.column),
+        priority=qn(fields[1].column),
+    )
+
+    pairs = iter(pairs)
+    with connection.cursor() as cursor:
+        while True:
+            batch = list(islice(pairs, batch_size))
+            if not batch:
+                break
+            cursor.execute(
+                sql.format(values=', '.join(['(%s, %s)'] * len(batch))),
+                [value for pair in batch for value in pair]
+            )
 
 
 class TreeNodeQuerySet(models.QuerySet):
@@ -16,33 +74,148 @@ class TreeNodeQuerySet(models.QuerySet):
         super().__init__(model, query, using, hints)
 
     def bulk_create(self, objs, batch_size=None, ignore_conflicts=False):
-        objs = super().bulk_create(objs, batch_size, ignore_conflicts)
+        # The nodes and their closure rows are committed together
+        with transaction.atomic(using=self.db, savepoint=False):
+            objs = super().bulk_create(objs, batch_size, ignore_conflicts)
+            # The pks are not set on MySQL or with ignore_conflicts, and the
+            # closure rows can't be built without them.
+            if any(obj.pk is None for obj in objs):
+                raise ValueError(
+                    "bulk_create() can't build the closure rows of nodes "
+                    "without a pk, set the pks of the new nodes"
+                )
+            self._bulk_create_closure(objs, batch_size)
+        update_cache_version(self.model, using=self.db)
+        return objs
 
-        objs = self.model.closure_model.bulk_create([
-            self.model.closure_model(
-                parent=item,
-                child=item,
-                depth=0
-            )
-        ] for item in objs)
+    def delete(self):
+        result = super().delete()
+        update_cache_version(self.model, using=self.db)
+        return result
+
+    delete.alters_data = True
+    delete.queryset_only = True
+
+    def _bulk_create_closure(self, objs, batch_size=None):
+        """Add the closure rows of the nodes created by bulk_create()"""
+
+        if connections[self.db].vendor == 'postgresql':
+            self._bulk_create_closure_paths(objs)
+            return
+
+        # Closure rows outnumber the nodes, so they are always inserted in
+        # batches to keep every statement within the backend limits.
+        closure_batch_size = batch_size or 1000
+
+        parent_pks = {item.tn_parent_id for item in objs}
+        parent_pks.discard(None)
+
+        # Ancestor paths of the existing parents, read with one query
+        closure = self.closure_model.objects.db_manager(self.db)
+        paths = dict()
+        if parent_pks:
+            rows = closure.filter(
+                child_id__in=parent_pks
+            ).values_list('child', 'parent', 'depth')
+            for child_pk, parent_pk, depth in rows:
+                paths.setdefault(child_pk, []).append((parent_pk, depth))
+
+        closure.bulk_insert(
+            self._iter_closure_rows(objs, parent_pks, paths),
+            batch_size=closure_batch_size
+        )
+
+    def _iter_closure_rows(self, objs, parent_pks, paths):
+        """Yield the (parent_pk, child_pk, depth) rows of the new nodes"""
+
+        parents = {node.pk: node.tn_parent_id for node in objs}
+
+        def get_path(pk):
+            # A parent may come after its children in objs: walk up to the
+            # first node whose path is known, then extend it back down.
+            chain = []
+            while pk not in paths and pk in parents:
+                if len(chain) == len(parents):
+                    raise ValueError("%s is its own ancestor" % pk)
+                chain.append(pk)
+                pk = parents[pk]
+            path = paths.get(pk, [])
+            for node_pk in reversed(chain):
+                path = [(node_pk, 0)] + [
+                    (parent_pk, depth + 1) for parent_pk, depth in path]
+                # Only the nodes that are parents of other nodes of this
+                # batch need their own path, leaves reuse nothing.
+                if node_pk in parent_pks:
+                    paths[node_pk] = path
+            return path
 
         for node in objs:
-            qs = self.model.closure_model.objects.all()
-            parents = qs.filter(child=node.tn_parent).values('parent', 'depth')
-            children = qs.filter(parent=node).values('child', 'depth')
-            objects = [
-                self.model.closure_model(
-                    parent_id=p['parent'],
-                    child_id=c['child'],
-                    depth=p['depth'] + c['depth'] + 1
+            for parent_pk, depth in get_path(node.pk):
+                yield parent_pk, node.pk, depth
+
+    def _bulk_create_closure_paths(self, objs):
+        """
+        Insert all closure rows of the new nodes with a single statement.
+
+        The adjacency list is walked up by a recursive CTE, so the result
+        does not depend on the order of objs or on the closure rows of the
+        nodes created in the same batch.
+        """
+
+        with connections[self.db].cursor() as cursor:
+            cursor.execute(self.model._get_closure_sql("""
+                INSERT INTO {closure} ({parent}, {child}, {depth})
+                WITH RECURSIVE r(pid, cid, d) AS (
+                    SELECT {pk}, {pk}, 0
+                    FROM {table}
+                    WHERE {pk} = ANY(%s)
+                    UNION ALL
+                    SELECT t.{tn_parent}, r.cid, r.d + 1
+                    FROM r JOIN {table} t ON t.{pk} = r.pid
+                    WHERE t.{tn_parent} IS NOT NULL
                 )
-                for p in parents
-                for c in children
-            ]
-            node._closure_model.objects.bulk_create(objects)
+                SELECT pid, cid, d FROM r
+            """, self.db), [[item.pk for item in objs]])
 
-        self.model._update_orders()
-        return objs
+
+class ClosureModelManager(models.Manager):
+    """Closure Model Manager Class"""
+
+    def bulk_insert(self, rows, batch_size=None):
+        """
+        Insert (parent_pk, child_pk, depth) tuples into the Closure Table.
+
+        Unlike bulk_create(), no model instances are built: the tuples are
+        passed to the database as multi-row INSERT statements. rows may be
+        any iterable, it is consumed one batch at a time.
+        """
+
+        db = self._db or router.db_for_write(self.model)
+        connection = connections[db]
+        opts = self.model._meta
+        fields = [
+            opts.get_field(name) for name in ('parent', 'child', 'depth')]
+        qn = connection.ops.quote_name
+
+        batch_size = batch_size or 1000
+        max_batch_size = connection.ops.bulk_batch_size(
+            fields, range(batch_size))
+        batch_size = min(batch_size, max(max_batch_size, 1))
+        sql = 'INSERT INTO {table} ({columns}) VALUES '.format(
+            table=qn(opts.db_table),
+            columns=', '.join(qn(field.column) for field in fields),
+        )
+
+        rows = iter(rows)
+        with connection.cursor() as cursor:
+            while True:
+                batch = list(islice(rows, batch_size))
+                if not batch:
+                    break
+                cursor.execute(
+                    sql + ', '.join(['(%s, %s, %s)'] * len(batch)),
+                    [value for row in batch for value in row]
+                )
 
 
 class TreeNodeManager(models.Manager):
@@ -54,11 +227,15 @@ class TreeNodeManager(models.Manager):
         """
 
         qs = TreeNodeQuerySet(self.model, using=self._db)
-        node_list = sorted([node for node in qs], key=lambda x: x.tn_order)
-        pk_list = [node.pk for node in node_list]
+
+        # The order only changes with the tree, so it is cached under the
+        # model cache version and computed again after every change.
+        cache_key = "{}_{}_{}_tree_order".format(
+            self.model._meta.label, self.db, get_cache_version(self.model))
+        pk_list = treenode_cache.get_or_set(cache_key, self._get_order)
 
         # Retrieve the queryset with the desired ordering
-        return qs.filter(pk__in=pk_list).order_by(
+        return qs.order_by(
             Case(*[When(pk=pk, then=Value(ordering))
                    for ordering, pk in enumerate(pk_list)],
                  default=Value(len(pk_list)),
@@ -66,4 +243,25 @@ class TreeNodeManager(models.Manager):
                  )
         )
 
+    def using(self, alias):
+        # The order is read from the closure table of the database used
+        return self.db_manager(alias).get_queryset()
+
+    def _get_order(self):
+        """Get the pks of all nodes sorted by materialized path"""
+
+        # Collect the priorities along every path with one closure query
+        # instead of computing tn_order node by node.
+        closure = self.model.closure_model.objects.db_manager(self.db)
+        rows = closure.order_by(
+            'child', '-depth'
+        ).values_list('child', 'parent__tn_priority').iterator(chunk_size=2000)
+        # Every path is packed into fixed-width big-endian integers: bytes
+        # compare in the same order as the lists, but in a single memcmp.
+        paths = dict()
+        for pk, group in groupby(rows, key=itemgetter(0)):
+            priorities = [priority for _, priority in group]
+            paths[pk] = pack('>%dI' % len(priorities), *priorities)
+        return sorted(paths, key=paths.get)
+
 # End
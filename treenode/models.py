@@ -5,26 +5,35 @@ TreeNode Models Module
 """
 
 
+from contextlib import nullcontext
+from functools import lru_cache
+from hashlib import md5
 from django.db import models
-from django.db import transaction
-from django.core.cache import caches
+from django.db.models import F
+from django.db import connections, router, transaction
 from django.utils.translation import gettext_lazy as _
 from six import with_metaclass
 from . import classproperty
+from .cache import treenode_cache, get_cache_version, update_cache_version
 from .compat import force_str
 from .factory import TreeFactory
-from .managers import TreeNodeManager
+from .managers import TreeNodeManager, update_priorities
 
 
-treenode_cache = caches['treenode']
+@lru_cache(maxsize=256)
+def get_indentation(mark, depth):
+    """Get the indentation of a node display at the given depth"""
+    return force_str(mark * depth)
+
 
 def cached_tree_method(func):
     """
     Decorator to cache the results of tree methods
 
     The decorator caches the results of the decorated method using the
-    closure_path of the node as part of the cache key. If the cache is
-    cleared or invalidated, the cached results will be recomputed.
+    model, the node pk and the arguments as the cache key. Every change of
+    the tree bumps the model cache version that prefixes the key, so the
+    cached results of other models are kept.
 
     Usage:
         @cached_tree_method
@@ -33,14 +42,25 @@ def cached_tree_method(func):
     """
 
     def wrapper(self, *args, **kwargs):
-        cache_key = f"{self.__class__.__name__}_{self.pk}_tree_{func.__name__}"
-        result = treenode_cache.get(cache_key)
+        model = self if isinstance(self, type) else self._meta.model
+        version = get_cache_version(model)
+        if isinstance(self, type):
+            # Class level results (roots, whole tree) are kept per model
+            cache_key = f"{model._meta.label}_{version}_tree_{func.__name__}"
+        else:
+            cache_key = "{}_{}_{}_tree_{}".format(
+                model._meta.label, version, self.pk, func.__name__)
 
-        if result is None:
-            result = func(self, *args, **kwargs)
-            treenode_cache.set(cache_key, result)
+        # Calls with different arguments must not share a result
+        if args or kwargs:
+            params = repr((
+                [getattr(arg, 'pk', arg) for arg in args],
+                sorted((k, getattr(v, 'pk', v)) for k, v in kwargs.items())
+            ))
+            cache_key += '_' + md5(params.encode()).hexdigest()
 
-        return result
+        return treenode_cache.get_or_set(
+            cache_key, lambda: func(self, *args, **kwargs))
 
     return wrapper
 
@@ -79,10 +99,9 @@ class TreeNodeModel(with_metaclass(TreeFactory, models.Model)):
     @classmethod
     def get_roots(cls):
         """Get a list with all root nodes"""
-        return list(item for item in cls.get_roots_queryset())
+        return list(cls.get_roots_queryset())
 
     @classmethod
-    @cached_tree_method
     def get_roots_queryset(cls):
         """Get root nodes queryset"""
         return cls.objects.filter(tn_parent=None)
@@ -92,11 +111,16 @@ class TreeNodeModel(with_metaclass(TreeFactory, models.Model)):
     def get_tree(cls, instance=None):
         """Get a n-dimensional dict representing the model tree"""
 
-        objs_list = list(instance,) if instance else cls.get_roots()
-        objs_tree = list()
-        for item in objs_list:
-            objs_tree.append(item.object2dict(item, []))
-        return objs_tree
+        if instance:
+            return [instance.object2dict(instance, [])]
+
+        # The whole tree is read with one query and assembled in memory
+        children = cls._get_children_map(cls._base_manager.all())
+        return [
+            root._node2dict(
+                root, children, '{:d}'.format(root.tn_priority), [])
+            for root in children.get(None, [])
+        ]
 
     @classmethod
     @cached_tree_method
@@ -110,46 +134,126 @@ class TreeNodeModel(with_metaclass(TreeFactory, models.Model)):
     def update_tree(cls):
         """Update tree manually, useful after bulk updates"""
 
-        treenode_cache.clear()
+        db = router.db_for_write(cls)
+        with transaction.atomic(using=db):
+            cls.closure_model.objects.db_manager(db).all().delete()
+
+            # The rows are built by the database one level at a time: the
+            # paths of a level are the paths of the previous one extended to
+            # the parent of their top node. No row goes through Python.
+            with connections[db].cursor() as cursor:
+                cursor.execute(cls._get_closure_sql("""
+                    INSERT INTO {closure} ({parent}, {child}, {depth})
+                    SELECT {pk}, {pk}, 0 FROM {table}
+                """, db))
+                depth = 0
+                while cursor.rowcount:
+                    cursor.execute(cls._get_closure_sql("""
+                        INSERT INTO {closure} ({parent}, {child}, {depth})
+                        SELECT t.{tn_parent}, c.{child}, %s
+                        FROM {closure} c
+                        JOIN {table} t ON t.{pk} = c.{parent}
+                        WHERE c.{depth} = %s AND t.{tn_parent} IS NOT NULL
+                    """, db), [depth + 1, depth])
+                    depth += 1
+
+        update_cache_version(cls, using=db)
 
-        cls.closure_model.objects.all().delete()
+    @classmethod
+    def bulk_save_tree(cls, changes):
+        """
+        Apply (pk, parent_pk, priority) changes to many nodes at once.
+
+        The changes are written in a single transaction: one UPDATE per new
+        parent, one priority update, and the closure rows of the moved
+        subtrees only are rebuilt. The cache is invalidated once at the end.
+        Unlike save(), the siblings are not shifted: the priorities are
+        stored as given.
+        """
 
-        # Apparently later, you should think about using iterators to reduce
-        # the amount of memory used.
-        # I'm sorry, I don't have time for that right now.
-
-        cls.closure_model.objects.bulk_create([
-            cls.closure_model(
-                parent_id=item.pk,
-                child_id=item.pk,
-                depth=0
-            )
-            for item in cls.objects.all()
-        ])
-
-        for node in cls.objects.all():
-            queryset = cls.closure_model.objects.all()
-            parents = queryset.filter(
-                child=node.parent).values('parent', 'depth')
-            children = queryset.filter(
-                parent=node).values('child', 'depth')
-            objects = [
-                cls.closure_model(
-                    parent_id=p['parent'],
-                    child_id=c['child'],
-                    depth=p['depth'] + c['depth'] + 1
+        changes = list(changes)
+        if not changes:
+            return
+
+        db = router.db_for_write(cls)
+        closure = cls.closure_model.objects.db_manager(db)
+        manager = cls._base_manager.db_manager(db)
+        with transaction.atomic(using=db):
+            old_parents = dict(manager.filter(
+                pk__in=[pk for pk, _, _ in changes]
+            ).values_list('pk', 'tn_parent'))
+            moved = {
+                pk: parent_pk for pk, parent_pk, _ in changes
+                if pk in old_parents and old_parents[pk] != parent_pk
+            }
+
+            # Every new parent must be a node of the tree: its own closure
+            # row is the start of the paths copied below.
+            targets = set(moved.values())
+            targets.discard(None)
+            missing = targets - set(closure.filter(
+                parent_id__in=targets, child_id__in=targets, depth=0
+            ).values_list('child', flat=True))
+            if missing:
+                raise ValueError(
+                    "%s can't be a parent: it is not a node of the tree"
+                    % missing.pop()
                 )
-                for p in parents
-                for c in children
-            ]
-            cls.closure_model.objects.bulk_create(objects)
+
+            if moved:
+                # The ancestors change for the moved nodes and their
+                # subtrees, the paths of every other node stay valid.
+                affected = set(closure.filter(
+                    parent_id__in=moved).values_list('child', flat=True))
+                parents = dict(manager.filter(
+                    pk__in=affected).values_list('pk', 'tn_parent'))
+                parents.update(moved)
+
+                # Walk up the new parents until a node whose paths are kept
+                rows, tops = [], dict()
+                for pk in affected:
+                    ancestor, depth = pk, 0
+                    while ancestor in affected:
+                        if depth == len(affected):
+                            raise ValueError(
+                                "%s can't be moved to its own descendant" % pk
+                            )
+                        rows.append((ancestor, pk, depth))
+                        ancestor, depth = parents[ancestor], depth + 1
+                    if ancestor is not None:
+                        tops[pk] = (ancestor, depth)
+
+                paths = dict()
+                for child_pk, parent_pk, depth in closure.filter(
+                        child_id__in={top for top, _ in tops.values()}
+                ).values_list('child', 'parent', 'depth'):
+                    paths.setdefault(child_pk, []).append((parent_pk, depth))
+                for pk, (top, top_depth) in tops.items():
+                    rows.extend(
+                        (parent_pk, pk, top_depth + depth)
+                        for parent_pk, depth in paths[top])
+
+                by_parent = dict()
+                for pk, parent_pk in moved.items():
+                    by_parent.setdefault(parent_pk, []).append(pk)
+                for parent_pk, pks in by_parent.items():
+                    manager.filter(pk__in=pks).update(
+                        tn_parent_id=parent_pk)
+
+                closure.filter(child_id__in=affected).delete()
+                closure.bulk_insert(rows)
+
+            update_priorities(
+                cls, db, ((pk, priority) for pk, _, priority in changes))
+
+        update_cache_version(cls, using=db)
 
     @classmethod
     def delete_tree(cls):
         """Delete the whole tree for the current node class"""
-        treenode_cache.clear()
         cls.closure_model.objects.all().delete()
-        cls.objects.all().delete()
+        cls._base_manager.all().delete()
+        update_cache_version(cls, using=router.db_for_write(cls))
 
     def get_ancestors(self, include_self=True, depth=None):
         """Get a list with all ancestors (ordered from root to self/parent)"""
@@ -158,14 +262,20 @@ class TreeNodeModel(with_metaclass(TreeFactory, models.Model)):
         if depth:
             options.update({'depth__lte': depth})
 
-        qs = self._closure_model.objects.filter(**options).order_by('-depth')
+        qs = self._closure_model.objects.select_related('parent').filter(
+            **options).order_by('-depth')
 
         return list(item.parent for item in qs)
 
     def get_ancestors_count(self, include_self=True, depth=None):
         """Get the ancestors count"""
 
-        return self.get_ancestors_queryset(include_self, depth).count()
+        # The closure rows are counted, no node is read
+        options = dict(child_id=self.pk, depth__gte=0 if include_self else 1)
+        if depth:
+            options.update({'depth__lte': depth})
+
+        return self._closure_model.objects.filter(**options).count()
 
     def get_ancestors_pks(self, include_self=True, depth=None):
         """Get the ancestors pks list"""
@@ -176,9 +286,8 @@ class TreeNodeModel(with_metaclass(TreeFactory, models.Model)):
 
         qs = self._closure_model.objects.filter(**options).order_by('-depth')
 
-        return list(item.parent.pk for item in qs)
+        return list(qs.values_list('parent', flat=True))
 
-    @cached_tree_method
     def get_ancestors_queryset(self, include_self=True, depth=None):
         """Get the ancestors queryset (self, ordered from parent to root)"""
 
@@ -186,16 +295,19 @@ class TreeNodeModel(with_metaclass(TreeFactory, models.Model)):
         if depth:
             options.update({'depth__lte': depth})
 
-        qs = self._closure_model.objects.filter(**options).order_by('-depth')
-        select = list(item.parent.pk for item in qs)
-        result = self._meta.model.objects.filter(pk__in=select)
-        return result
+        qs = self._closure_model.objects.filter(**options)
+        return self._meta.model.objects.filter(pk__in=qs.values('parent'))
 
     @cached_tree_method
     def get_breadcrumbs(self, attr=None):
         """Get the breadcrumbs to current node (self, included)"""
 
         qs = self._closure_model.objects.filter(child=self).order_by('-depth')
+        if attr and attr in self._get_concrete_field_names():
+            # A field is read by the closure query itself
+            return list(qs.values_list('parent__%s' % attr, flat=True))
+
+        qs = qs.select_related('parent')
         if attr:
             return list(getattr(item.parent, attr) for item in qs)
         else:
@@ -204,19 +316,23 @@ class TreeNodeModel(with_metaclass(TreeFactory, models.Model)):
     def get_children(self):
         """Get a list containing all children"""
 
-        return list(self.self.get_children_queryset())
+        return list(self.get_children_queryset())
 
     def get_children_count(self):
         """Get the children count"""
 
-        return self.get_children_queryset().count()
+        return self._meta.model._base_manager.filter(
+            tn_parent_id=self.pk).count()
 
     def get_children_pks(self):
         """Get the children pks list"""
 
-        return [ch.pk for ch in self.get_children_queryset()]
+        # Children share the parent, so their tree order is the priority
+        # order and the tree ordering of the default manager is not needed.
+        qs = self._meta.model._base_manager.filter(tn_parent_id=self.pk)
+        return list(
+            qs.order_by('tn_priority', 'pk').values_list('pk', flat=True))
 
-    @cached_tree_method
     def get_children_queryset(self):
         """Get the children queryset"""
         return self._meta.model.objects.filter(tn_parent=self.id)
@@ -224,11 +340,10 @@ class TreeNodeModel(with_metaclass(TreeFactory, models.Model)):
     def get_depth(self):
         """Get the node depth (self, how many levels of descendants)"""
 
-        depths = self._closure_model.objects.filter(parent=self).values_list(
-            'depth',
-            flat=True
-        )
-        return max(depths)
+        # An unsaved node has no closure rows yet
+        depth = self._closure_model.objects.filter(
+            parent_id=self.pk).aggregate(models.Max('depth'))['depth__max']
+        return depth or 0
 
     def get_descendants(self, include_self=False, depth=None):
         """Get a list containing all descendants"""
@@ -236,7 +351,13 @@ class TreeNodeModel(with_metaclass(TreeFactory, models.Model)):
 
     def get_descendants_count(self, include_self=False, depth=None):
         """Get the descendants count"""
-        return self.get_descendants_queryset().count()
+
+        # The closure rows are counted, no node is read
+        options = dict(parent_id=self.pk, depth__gte=0 if include_self else 1)
+        if depth:
+            options.update({'depth__lte': depth})
+
+        return self._closure_model.objects.filter(**options).count()
 
     def get_descendants_pks(self, include_self=False, depth=None):
         """Get the descendants pks list"""
@@ -245,14 +366,17 @@ class TreeNodeModel(with_metaclass(TreeFactory, models.Model)):
             options.update({'depth__lte': depth})
 
         qs = self._closure_model.objects.filter(**options)
-        return [ch.child.pk for ch in qs] if qs else []
+        return list(qs.values_list('child', flat=True))
 
-    @cached_tree_method
     def get_descendants_queryset(self, include_self=False, depth=None):
         """Get the descendants queryset"""
 
-        pks = self.get_descendants_pks(include_self, depth)
-        return self._meta.model.objects.filter(pk__in=pks)
+        options = dict(parent_id=self.pk, depth__gte=0 if include_self else 1)
+        if depth:
+            options.update({'depth__lte': depth})
+
+        qs = self._closure_model.objects.filter(**options)
+        return self._meta.model.objects.filter(pk__in=qs.values('child'))
 
     def get_descendants_tree(self):
         """Get a n-dimensional dict representing the model tree"""
@@ -267,32 +391,37 @@ class TreeNodeModel(with_metaclass(TreeFactory, models.Model)):
 
     def get_first_child(self):
         """Get the first child node"""
-        return self.get_children_queryset().first()
+        # Siblings are in priority order, the tree ordering is not needed
+        return self._meta.model._base_manager.filter(
+            tn_parent_id=self.pk).order_by('tn_priority', 'pk').first()
 
     def get_index(self):
         """Get the node index (self, index in node.parent.children list)"""
-        source = self.get_siblings()
-        return source.index(self)
+        # Siblings are ordered by priority, then by pk
+        return self._meta.model._base_manager.filter(
+            models.Q(tn_priority__lt=self.tn_priority) |
+            models.Q(tn_priority=self.tn_priority, pk__lt=self.pk),
+            tn_parent_id=self.tn_parent_id
+        ).count()
 
     def get_last_child(self):
         """Get the last child node"""
-        return self.get_children_queryset().last()
+        return self._meta.model._base_manager.filter(
+            tn_parent_id=self.pk).order_by('tn_priority', 'pk').last()
 
     def get_level(self):
         """Get the node level (self, starting from 1)"""
 
-        levels = self._closure_model.objects.filter(child=self).values_list(
-            'depth',
-            flat=True
-        )
-        return max(levels) + 1
+        depth = self._closure_model.objects.filter(
+            child_id=self.pk).aggregate(models.Max('depth'))['depth__max']
+        return (depth or 0) + 1
 
     def get_path(self, prefix='', suffix='', delimiter='.', format_str=''):
         """Return Materialized Path of node"""
 
         str_ = '{%s}' % format_str
         return prefix + delimiter.join(
-            str_.format(i) for i in self.get_breadcrumbs(attr='tn_priority')
+            str_.format(i) for i in self._get_priority_path()
         ) + suffix
 
     def get_parent(self):
@@ -301,7 +430,7 @@ class TreeNodeModel(with_metaclass(TreeFactory, models.Model)):
 
     def get_parent_pk(self):
         """Get the parent node pk"""
-        return self.tn_parent.pk if self.tn_parent else None
+        return self.tn_parent_id
 
     def set_parent(self, parent_obj):
         """Set the parent node"""
@@ -316,12 +445,16 @@ class TreeNodeModel(with_metaclass(TreeFactory, models.Model)):
 
     def get_root(self):
         """Get the root node for the current node"""
-        qs = self._closure_model.objects.filter(child=self).order_by('depth')
-        return qs.last().parent if qs.count() > 0 else None
+        qs = self._closure_model.objects.select_related('parent').filter(
+            child_id=self.pk).order_by('-depth')
+        item = qs.first()
+        return item.parent if item else None
 
     def get_root_pk(self):
         """Get the root node pk for the current node"""
-        self.get_root().pk
+        qs = self._closure_model.objects.filter(
+            child_id=self.pk).order_by('-depth')
+        return qs.values_list('parent', flat=True).first()
 
     def get_siblings(self):
         """Get a list with all the siblings"""
@@ -329,73 +462,88 @@ class TreeNodeModel(with_metaclass(TreeFactory, models.Model)):
 
     def get_siblings_count(self):
         """Get the siblings count"""
-        return self.get_siblings_queryset().count()
+        return self._meta.model._base_manager.filter(
+            tn_parent_id=self.tn_parent_id).exclude(pk=self.pk).count()
 
     def get_siblings_pks(self):
         """Get the siblings pks list"""
-        return [item.pk for item in self.get_siblings_queryset()]
+        qs = self._meta.model._base_manager.filter(
+            tn_parent_id=self.tn_parent_id).exclude(pk=self.pk)
+        return list(
+            qs.order_by('tn_priority', 'pk').values_list('pk', flat=True))
 
-    @cached_tree_method
     def get_siblings_queryset(self):
         """Get the siblings queryset"""
-        if self.tn_parent:
-            queryset = self.tn_parent.tn_children.all()
-        else:
-            queryset = self._meta.model.objects.filter(tn_parent__isnull=True)
+        queryset = self._meta.model.objects.filter(
+            tn_parent_id=self.tn_parent_id)
         return queryset.exclude(pk=self.pk)
 
     def is_ancestor_of(self, target_obj):
         """Return True if the current node is ancestor of target_obj"""
-        return self.pk in target_obj.get_ancestors_pks()
+        return self._closure_model.objects.filter(
+            parent_id=self.pk, child_id=target_obj.pk).exists()
 
     def is_child_of(self, target_obj):
         """Return True if the current node is child of target_obj"""
 
-        return self.pk in target_obj.get_children_pks()
+        return self.tn_parent_id == target_obj.pk
 
     def is_descendant_of(self, target_obj):
         """Return True if the current node is descendant of target_obj"""
-        return self.pk in target_obj.get_descendants_pks()
+        return self._closure_model.objects.filter(
+            parent_id=target_obj.pk, child_id=self.pk, depth__gte=1).exists()
 
     def is_first_child(self):
         """Return True if the current node is the first child"""
-        return self.tn_priority == 0
+        # Same tie-break as get_index() and get_first_child()
+        return not self._meta.model._base_manager.filter(
+            models.Q(tn_priority__lt=self.tn_priority) |
+            models.Q(tn_priority=self.tn_priority, pk__lt=self.pk),
+            tn_parent_id=self.tn_parent_id
+        ).exists()
 
     def is_last_child(self):
         """Return True if the current node is the last child"""
-
-        return self.tn_priority == self.get_siblings_count() - 1
+        return not self._meta.model._base_manager.filter(
+            models.Q(tn_priority__gt=self.tn_priority) |
+            models.Q(tn_priority=self.tn_priority, pk__gt=self.pk),
+            tn_parent_id=self.tn_parent_id
+        ).exists()
 
     def is_leaf(self):
         """Return True if the current node is leaf (self, it has not children)"""
-        return self.tn_children.count() == 0
+        return not self._meta.model._base_manager.filter(
+            tn_parent_id=self.pk).exists()
 
     def is_parent_of(self, target_obj):
         """Return True if the current node is parent of target_obj"""
-        return self == target_obj.tn_parent
+        return self.pk == target_obj.tn_parent_id
 
     def is_root(self):
         """Return True if the current node is root"""
-        return self.tn_parent is None
+        return self.tn_parent_id is None
 
     def is_root_of(self, target_obj):
         """Return True if the current node is root of target_obj"""
-        return self == target_obj.get_root()
+        return self.pk == target_obj.get_root_pk()
 
     def is_sibling_of(self, target_obj):
         """Return True if the current node is sibling of target_obj"""
-        return self in target_obj.tn_parent.tn_children.all()
-
-    # I think this method is not needed.
-    # Clearing entries in the Closure Table will happen automatically
-    # via cascading deletion
+        return (
+            self.tn_parent_id == target_obj.tn_parent_id and
+            self.pk != target_obj.pk
+        )
 
-    # def delete(self, cascade=True, *args, **kwargs):
-    #    """Delete a node if cascade=True (default behaviour), children and
-    #    descendants will be deleted too, otherwise children's parent will be
-    #    set to None (then children become roots)"""
+    def delete(self, *args, **kwargs):
+        """Delete the node, its descendants are deleted too"""
 
-    # pass
+        # The entries of the Closure Table are removed by cascading deletion,
+        # only the cached results must be invalidated.
+        db = kwargs.get('using') or router.db_for_write(
+            self._meta.model, instance=self)
+        result = super().delete(*args, **kwargs)
+        update_cache_version(self._meta.model, using=db)
+        return result
 
     # Public properties
     # All properties map a get_{{property}}() method.
@@ -517,44 +665,95 @@ class TreeNodeModel(with_metaclass(TreeFactory, models.Model)):
     # The usage of these methods is only allowed by developers. In future
     # versions, these methods may be changed or removed without any warning.
 
-    @property
-    def _closure_model(self):
-        return self._meta.model.closure_model
-
     @property
     def tn_order(self):
-        path = self.get_breadcrumbs(attr='tn_priority')
+        path = self._get_priority_path()
         return ''.join(['{:0>6g}'.format(i) for i in path])
 
+    @classmethod
+    @lru_cache(maxsize=None)
+    def _get_concrete_field_names(cls):
+        """Get the names of the model fields stored as plain values"""
+        return frozenset(
+            field.name for field in cls._meta.concrete_fields
+            if not field.is_relation)
+
+    @classmethod
+    @lru_cache(maxsize=None)
+    def _get_closure_names(cls, using):
+        """Get the quoted table and column names of the closure statements"""
+
+        # Cached per database alias, which fixes the backend and its quoting
+        opts = cls._closure_model._meta
+        qn = connections[using].ops.quote_name
+        return dict(
+            closure=qn(opts.db_table),
+            parent=qn(opts.get_field('parent').column),
+            child=qn(opts.get_field('child').column),
+            depth=qn(opts.get_field('depth').column),
+            table=qn(cls._meta.db_table),
+            pk=qn(cls._meta.pk.column),
+            tn_parent=qn(cls._meta.get_field('tn_parent').column),
+        )
+
+    @classmethod
+    @lru_cache(maxsize=None)
+    def _get_closure_sql(cls, template, using):
+        """Format a closure statement for the model and the database once"""
+        return template.format(**cls._get_closure_names(using))
+
+    def _get_priority_path(self):
+        """Get the priorities from the root to the node with one query"""
+
+        qs = self._closure_model.objects.filter(child=self).order_by('-depth')
+        return list(qs.values_list('parent__tn_priority', flat=True))
+
     @cached_tree_method
     def object2dict(self, instance, exclude=[]):
         """Convert Class Object to python dict"""
 
-        result = dict()
-
         if not hasattr(instance, '__dict__'):
             return instance
 
-        new_subdic = dict(vars(instance))
-        for key, value in new_subdic.items():
-            if key.startswith('_') or key in exclude:
-                continue
-            result.update({key: self.object2dict(value, exclude)})
-
-        childs = instance.tn_children.all()
-        if childs.count() > 0:
-            result.update({
-                'children': [
-                    obj.object2dict(obj, exclude)
-                    for obj in childs.all()]
-            })
-        result.update({'path': instance.get_path(format_str=':d')})
+        # The whole subtree is read with one query and assembled in memory
+        qs = self._closure_model.objects.filter(parent=instance)
+        children = self._get_children_map(
+            self._meta.model._base_manager.filter(pk__in=qs.values('child')))
+        return self._node2dict(
+            instance, children, instance.get_path(format_str=':d'), exclude)
+
+    @classmethod
+    def _get_children_map(cls, queryset):
+        """Group the nodes of queryset by parent pk, in priority order"""
+
+        children = dict()
+        nodes = queryset.order_by('tn_priority', 'pk').iterator(
+            chunk_size=2000)
+        for node in nodes:
+            children.setdefault(node.tn_parent_id, []).append(node)
+        return children
+
+    def _node2dict(self, node, children, path, exclude):
+        """Convert node and its descendants from children map to dict"""
+
+        result = {
+            key: value
+            for key, value in vars(node).items()
+            if not key.startswith('_') and key not in exclude
+        }
+        if node.pk in children:
+            result['children'] = [
+                self._node2dict(
+                    child, children,
+                    path + '.{:d}'.format(child.tn_priority), exclude)
+                for child in children[node.pk]
+            ]
+        result['path'] = path
         return result
 
-    @cached_tree_method
     def get_display(self, indent=True, mark='— '):
-        indentation = (mark * self.tn_ancestors_count) if indent else ''
-        indentation = force_str(indentation)
+        depth = self.get_ancestors_count(include_self=False) if indent else 0
+        indentation = get_indentation(mark, depth)
         text = self.get_display_text()
         text = force_str(text)
         return indentation + text
@@ -576,93 +775,206 @@ class TreeNodeModel(with_metaclass(TreeFactory, models.Model)):
             text = self.pk
         return force_str(text)
 
-    @transaction.atomic
-    def _insert(self):
+    def _insert(self, db):
         """Adds a new entry to the Adjacency Table and the Closure Table"""
 
-        treenode_cache.clear()
-
-        instance = self._closure_model.objects.create(
-            parent=self,
-            child=self,
-            depth=0
-        )
-        instance.save()
-
-        qs = self._closure_model.objects.all()
-        parents = qs.filter(child=self.tn_parent).values('parent', 'depth')
-        children = qs.filter(parent=self).values('child', 'depth')
-        objects = [
-            self._closure_model(
-                parent_id=p['parent'],
-                child_id=c['child'],
-                depth=p['depth'] + c['depth'] + 1
-            )
-            for p in parents
-            for c in children
-        ]
-        self._closure_model.objects.bulk_create(objects)
-
-    @transaction.atomic
-    def _move_to(self, old_parent):
-        treenode_cache.clear()
-
-        target = self.tn_parent
-        qs = self._closure_model.objects.all()
-        subtree = qs.filter(parent=self).values('child', 'depth')
-        supertree = qs.filter(child=target).values('parent', 'depth')
-
-        # Step 1. Delete
-        subtree_pks = [node.child.pk for node in qs.filter(parent=self)]
-        qs.filter(child_id__in=subtree_pks).exclude(
-            parent_id__in=subtree_pks).delete()
-
-        # Step 2. Insert
-        objects = [
-            self._closure_model(
-                parent_id=p['parent'],
-                child_id=c['child'],
-                depth=p['depth'] + c['depth'] + 1
-            )
-            for p in supertree
-            for c in subtree
-        ]
-        self._closure_model.objects.bulk_create(objects)
-
-    def _order(self):
-
-        treenode_cache.clear()
+        # A new node has no descendants: its rows are the path to itself
+        # and the paths of its parent extended by one level, copied by the
+        # database without a round trip. The path to itself is selected
+        # from the node row, a SELECT without FROM isn't portable.
+        with connections[db].cursor() as cursor:
+            cursor.execute(self._get_closure_sql("""
+                INSERT INTO {closure} ({parent}, {child}, {depth})
+                SELECT {parent}, %s, {depth} + 1
+                FROM {closure} WHERE {child} = %s
+                UNION ALL
+                SELECT {pk}, {pk}, 0 FROM {table} WHERE {pk} = %s
+            """, db), [self.pk, self.tn_parent_id, self.pk])
+
+    def _move_to(self, db):
+        vendor = connections[db].vendor
+        if vendor == 'postgresql':
+            self._move_to_upsert(db)
+            return
+
+        # Step 1. Delete the paths from the old ancestors to the subtree
+        if vendor == 'mysql':
+            # MySQL can't delete from a table selected in a subquery
+            qs = self._closure_model.objects.db_manager(db).all()
+            subtree_pks = list(qs.filter(parent=self).values_list(
+                'child', flat=True))
+            qs.filter(child_id__in=subtree_pks).exclude(
+                parent_id__in=subtree_pks).delete()
+        else:
+            with connections[db].cursor() as cursor:
+                cursor.execute(self._get_closure_sql("""
+                    DELETE FROM {closure}
+                    WHERE {child} IN (
+                        SELECT {child} FROM {closure} WHERE {parent} = %s
+                    )
+                    AND {parent} NOT IN (
+                        SELECT {child} FROM {closure} WHERE {parent} = %s
+                    )
+                """, db), [self.pk, self.pk])
+
+        # Step 2. Insert the cross product of the new ancestors and the
+        # subtree, a new root has no ancestors
+        if self.tn_parent_id is None:
+            return
+        with connections[db].cursor() as cursor:
+            cursor.execute(self._get_closure_sql("""
+                INSERT INTO {closure} ({parent}, {child}, {depth})
+                SELECT sup.{parent}, sub.{child},
+                       sup.{depth} + sub.{depth} + 1
+                FROM {closure} sup, {closure} sub
+                WHERE sup.{child} = %s AND sub.{parent} = %s
+            """, db), [self.tn_parent_id, self.pk])
+
+    def _move_to_upsert(self, db):
+        """
+        Rebuild the subtree paths with an upsert and a single delete.
 
-        queryset = self.get_siblings_queryset()
+        Rows shared by the old and the new position (common ancestors) are
+        updated in place instead of being deleted and inserted again.
+        """
 
-        if self.tn_priority > queryset.count():
-            self.tn_priority = queryset.count()
+        with connections[db].cursor() as cursor:
+            if self.tn_parent_id is not None:
+                cursor.execute(self._get_closure_sql("""
+                    INSERT INTO {closure} ({parent}, {child}, {depth})
+                    SELECT sup.{parent}, sub.{child},
+                           sup.{depth} + sub.{depth} + 1
+                    FROM {closure} sup, {closure} sub
+                    WHERE sup.{child} = %s AND sub.{parent} = %s
+                    ON CONFLICT ({parent}, {child})
+                    DO UPDATE SET {depth} = EXCLUDED.{depth}
+                """, db), [self.tn_parent_id, self.pk])
+
+            # NOT EXISTS is planned as an anti-join probing the unique
+            # (parent, child) index, NOT IN can't be: its subquery is either
+            # hashed in memory or run again for every row.
+            cursor.execute(self._get_closure_sql("""
+                DELETE FROM {closure} AS c
+                WHERE EXISTS (
+                    SELECT 1 FROM {closure} sub
+                    WHERE sub.{parent} = %s AND sub.{child} = c.{child}
+                )
+                AND NOT EXISTS (
+                    SELECT 1 FROM {closure} sub
+                    WHERE sub.{parent} = %s AND sub.{child} = c.{parent}
+                )
+                AND NOT EXISTS (
+                    SELECT 1 FROM {closure} sup
+                    WHERE sup.{child} = %s AND sup.{parent} = c.{parent}
+                )
+            """, db), [self.pk, self.pk, self.tn_parent_id])
+
+    def _order(self, db, old_parent_id=None, old_priority=None):
+        """Shift the siblings to make room for the node at tn_priority"""
+
+        manager = self._meta.model._base_manager.db_manager(db)
+        siblings = manager.filter(
+            tn_parent_id=self.tn_parent_id).exclude(pk=self.pk)
+        # old_priority is None for a new node
+        moved = old_priority is not None
+        same_parent = moved and old_parent_id == self.tn_parent_id
+
+        if moved and not same_parent:
+            # Close the gap left among the siblings at the old position
+            manager.filter(
+                tn_parent_id=old_parent_id,
+                tn_priority__gt=old_priority
+            ).update(tn_priority=F('tn_priority') - 1)
+
+        stats = siblings.aggregate(
+            count=models.Count('pk'),
+            distinct=models.Count('tn_priority', distinct=True),
+            top=models.Max('tn_priority'),
+            total=models.Sum('tn_priority'),
+        )
+        count = stats['count']
+        if self.tn_priority > count:
+            self.tn_priority = count
+
+        # Range shifts only keep the priorities dense when the siblings
+        # already are, i.e. they hold every priority from 0 to count except
+        # the node's old one. Otherwise (after bulk_create(), for instance)
+        # all the siblings are renumbered.
+        gap = old_priority if same_parent else count
+        if not (stats['distinct'] == count and
+                (stats['top'] or 0) <= count and
+                (stats['total'] or 0) == count * (count + 1) // 2 - gap):
+            self._renumber(siblings)
+            return
+
+        manager.filter(pk=self.pk).update(tn_priority=self.tn_priority)
+        if not same_parent:
+            siblings.filter(
+                tn_priority__gte=self.tn_priority
+            ).update(tn_priority=F('tn_priority') + 1)
+        elif self.tn_priority > old_priority:
+            siblings.filter(
+                tn_priority__gt=old_priority,
+                tn_priority__lte=self.tn_priority
+            ).update(tn_priority=F('tn_priority') - 1)
+        else:
+            siblings.filter(
+                tn_priority__gte=self.tn_priority,
+                tn_priority__lt=old_priority
+            ).update(tn_priority=F('tn_priority') + 1)
 
-        siblings = list(node for node in queryset)
-        sorted_siblings = sorted(siblings, key=lambda x: x.tn_priority)
-        sorted_siblings.insert(self.tn_priority, self)
+    def _renumber(self, siblings):
+        """Give the node and its siblings consecutive priorities"""
 
-        for index in range(len(sorted_siblings)):
-            sorted_siblings[index].tn_priority = index
+        pks = list(siblings.order_by('tn_priority', 'pk').values_list(
+            'pk', flat=True))
+        pks.insert(self.tn_priority, self.pk)
 
-        self._meta.model.objects.bulk_update(
-            sorted_siblings, ('tn_priority', ))
+        update_priorities(
+            self._meta.model, siblings.db,
+            ((pk, priority) for priority, pk in enumerate(pks)))
 
     def save(self, force_insert=False, *args, **kwargs):
-        treenode_cache.clear()
-
-        try:
-            old = self._meta.model.objects.get(pk=self.pk)
-            old_parent = old.tn_parent
-        except self._meta.model.DoesNotExist:
+        # The node, its siblings and its closure rows are all written to the
+        # database the node is saved to.
+        db = kwargs.get('using') or router.db_for_write(
+            self._meta.model, instance=self)
+
+        # Internal lookups use the base manager: the default one computes
+        # the tree ordering, which is useless for a single row. Only the
+        # old position of a saved node is read, new nodes need no query.
+        old = None
+        if not self._state.adding:
+            old = self._meta.model._base_manager.db_manager(db).filter(
+                pk=self.pk).values_list('tn_parent', 'tn_priority').first()
+        if old is None:
             force_insert = True
+        tree_changed = old != (self.tn_parent_id, self.tn_priority)
+
+        # A node can't be moved under itself or one of its descendants
+        moved = old is not None and old[0] != self.tn_parent_id
+        if moved and self.tn_parent_id is not None:
+            if self._closure_model.objects.db_manager(db).filter(
+                    parent_id=self.pk, child_id=self.tn_parent_id).exists():
+                raise ValueError(
+                    "%s can't be moved to its own descendant" % self
+                )
+
+        # Plain field changes need no transaction of their own
+        with transaction.atomic(using=db) if tree_changed else nullcontext():
+            super().save(*args, **kwargs)
+
+            # Siblings are only reordered when the node position has changed
+            if tree_changed:
+                self._order(db, *(old or ()))
 
-        super().save(*args, **kwargs)
-        self._order()
+            if force_insert:
+                self._insert(db)
+            elif moved:
+                self._move_to(db)
 
-        if force_insert:
-            self._insert()
-        elif old_parent != self.tn_parent:
-            self._move_to(old_parent)
+        # Invalidated once all the writes are committed, so that no result
+        # read in between is cached under the new version.
+        update_cache_version(self._meta.model, using=db)
 
     # The end
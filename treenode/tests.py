@@ -1,3 +1,294 @@
+from django.db import models, transaction
 from django.test import TestCase
 
-# Create your tests here.
+from .cache import get_cache_version
+from .models import TreeNodeModel
+
+
+class Node(TreeNodeModel):
+
+    treenode_display_field = 'name'
+
+    name = models.CharField(max_length=50)
+
+    class Meta(TreeNodeModel.Meta):
+        app_label = 'treenode'
+
+
+class PlainNode(TreeNodeModel):
+
+    name = models.CharField(max_length=50)
+
+    objects = models.Manager()
+
+    class Meta(TreeNodeModel.Meta):
+        app_label = 'treenode'
+
+
+class BulkSaveTreeTest(TestCase):
+
+    def setUp(self):
+        # a
+        # |-- b
+        # |   `-- c
+        # `-- d
+        # e
+        self.a = Node.objects.create(name='a')
+        self.b = Node.objects.create(name='b', tn_parent=self.a)
+        self.c = Node.objects.create(name='c', tn_parent=self.b)
+        self.d = Node.objects.create(name='d', tn_parent=self.a)
+        self.e = Node.objects.create(name='e')
+
+    def get_closure(self):
+        return sorted(Node.closure_model.objects.values_list(
+            'parent', 'child', 'depth'))
+
+    def assertClosureValid(self):
+        closure = self.get_closure()
+        Node.update_tree()
+        self.assertEqual(closure, self.get_closure())
+
+    def test_move(self):
+        Node.bulk_save_tree([(self.b.pk, self.e.pk, 0)])
+        self.b.refresh_from_db()
+        self.assertEqual(self.b.tn_parent_id, self.e.pk)
+        self.assertEqual(
+            self.c.get_ancestors_pks(), [self.e.pk, self.b.pk, self.c.pk])
+        self.assertClosureValid()
+
+    def test_nested_move(self):
+        # b goes under e while its child c becomes a root
+        Node.bulk_save_tree([
+            (self.b.pk, self.e.pk, 0),
+            (self.c.pk, None, 2),
+        ])
+        self.assertEqual(self.c.get_ancestors_pks(), [self.c.pk])
+        self.assertEqual(
+            self.b.get_ancestors_pks(), [self.e.pk, self.b.pk])
+        self.assertClosureValid()
+
+    def test_priorities(self):
+        Node.bulk_save_tree([
+            (self.b.pk, self.a.pk, 1),
+            (self.d.pk, self.a.pk, 0),
+        ])
+        self.assertEqual(self.a.get_children_pks(), [self.d.pk, self.b.pk])
+
+    def test_cycle(self):
+        closure = self.get_closure()
+        with self.assertRaises(ValueError):
+            Node.bulk_save_tree([(self.a.pk, self.c.pk, 0)])
+        with self.assertRaises(ValueError):
+            Node.bulk_save_tree([
+                (self.a.pk, self.e.pk, 0),
+                (self.e.pk, self.d.pk, 0),
+            ])
+        self.a.refresh_from_db()
+        self.assertIsNone(self.a.tn_parent_id)
+        self.assertEqual(closure, self.get_closure())
+
+    def test_bad_parent(self):
+        closure = self.get_closure()
+        with self.assertRaises(ValueError):
+            Node.bulk_save_tree([(self.a.pk, 999, 0)])
+        self.assertEqual(closure, self.get_closure())
+
+
+class MoveTest(TestCase):
+
+    def setUp(self):
+        # a
+        # |-- b
+        # |   `-- c
+        # |       `-- f
+        # `-- d
+        # e
+        self.a = Node.objects.create(name='a')
+        self.b = Node.objects.create(name='b', tn_parent=self.a)
+        self.c = Node.objects.create(name='c', tn_parent=self.b)
+        self.f = Node.objects.create(name='f', tn_parent=self.c)
+        self.d = Node.objects.create(name='d', tn_parent=self.a)
+        self.e = Node.objects.create(name='e')
+
+    def get_paths(self, *nodes):
+        return {
+            node.name: sorted(Node.closure_model.objects.filter(
+                child=node).values_list('parent__name', 'depth'))
+            for node in nodes
+        }
+
+    def move(self, node, parent):
+        node.tn_parent = parent
+        node.save()
+
+    def test_move(self):
+        self.move(self.b, self.e)
+        self.assertEqual(self.get_paths(self.b, self.c, self.f), {
+            'b': [('b', 0), ('e', 1)],
+            'c': [('b', 1), ('c', 0), ('e', 2)],
+            'f': [('b', 2), ('c', 1), ('e', 3), ('f', 0)],
+        })
+
+    def test_move_deeper(self):
+        self.move(self.b, self.d)
+        self.assertEqual(self.get_paths(self.b, self.c, self.f), {
+            'b': [('a', 2), ('b', 0), ('d', 1)],
+            'c': [('a', 3), ('b', 1), ('c', 0), ('d', 2)],
+            'f': [('a', 4), ('b', 2), ('c', 1), ('d', 3), ('f', 0)],
+        })
+
+    def test_move_to_root(self):
+        self.move(self.c, None)
+        self.assertEqual(self.get_paths(self.c, self.f), {
+            'c': [('c', 0)],
+            'f': [('c', 1), ('f', 0)],
+        })
+        self.assertEqual(self.get_paths(self.b), {'b': [('a', 1), ('b', 0)]})
+
+
+class BulkCreateTest(TestCase):
+
+    def test_children_before_parents(self):
+        Node.objects.bulk_create([
+            Node(pk=3, name='c', tn_parent_id=2),
+            Node(pk=4, name='d', tn_parent_id=3),
+            Node(pk=2, name='b', tn_parent_id=1),
+            Node(pk=1, name='a'),
+        ])
+        closure = sorted(Node.closure_model.objects.values_list(
+            'parent', 'child', 'depth'))
+        Node.update_tree()
+        self.assertEqual(closure, sorted(
+            Node.closure_model.objects.values_list('parent', 'child', 'depth')
+        ))
+        self.assertEqual(Node.objects.get(pk=4).get_ancestors_pks(),
+                         [1, 2, 3, 4])
+
+    def test_missing_pks(self):
+        # No backend sets the pks with ignore_conflicts
+        with self.assertRaises(ValueError), transaction.atomic():
+            Node.objects.bulk_create([Node(name='a')], ignore_conflicts=True)
+        self.assertFalse(Node.objects.exists())
+
+
+class CacheTest(TestCase):
+
+    def setUp(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.alpha = Node.objects.create(name='alpha')
+            self.beta = Node.objects.create(name='beta', tn_parent=self.alpha)
+
+    def test_version_bumped_on_commit(self):
+        version = get_cache_version(Node)
+        with self.captureOnCommitCallbacks() as callbacks:
+            Node.objects.create(name='gamma', tn_parent=self.alpha)
+        self.assertEqual(version, get_cache_version(Node))
+        for callback in callbacks:
+            callback()
+        self.assertNotEqual(version, get_cache_version(Node))
+
+    def test_order(self):
+        gamma = Node.objects.create(name='gamma', tn_parent=self.alpha)
+        self.assertEqual(list(Node.objects.all()),
+                         [self.alpha, self.beta, gamma])
+        with self.captureOnCommitCallbacks(execute=True):
+            gamma.tn_priority = 0
+            gamma.save()
+        self.assertEqual(list(Node.objects.all()),
+                         [self.alpha, gamma, self.beta])
+
+    def test_delete(self):
+        self.assertIn('beta', Node.get_tree_display())
+        with self.captureOnCommitCallbacks(execute=True):
+            self.beta.delete()
+        self.assertNotIn('beta', Node.get_tree_display())
+
+    def test_queryset_delete(self):
+        self.assertIn('beta', Node.get_tree_display())
+        with self.captureOnCommitCallbacks(execute=True):
+            Node.objects.filter(pk=self.alpha.pk).delete()
+        self.assertEqual('', Node.get_tree_display())
+
+
+class SiblingsTest(TestCase):
+
+    def test_duplicated_priorities(self):
+        root = Node.objects.create(name='root')
+        a, b = Node.objects.bulk_create([
+            Node(name='a', tn_parent=root, tn_priority=0),
+            Node(name='b', tn_parent=root, tn_priority=0),
+        ])
+        self.assertEqual(root.get_first_child(), a)
+        self.assertEqual(root.get_last_child(), b)
+        self.assertEqual([a.is_first_child(), b.is_first_child()],
+                         [True, False])
+        self.assertEqual([a.is_last_child(), b.is_last_child()],
+                         [False, True])
+
+    def test_custom_manager(self):
+        root = PlainNode.objects.create(name='root')
+        a, b = PlainNode.objects.bulk_create([
+            PlainNode(name='a', tn_parent=root, tn_priority=0),
+            PlainNode(name='b', tn_parent=root, tn_priority=0),
+        ])
+        children = root.tn_children.order_by('tn_priority')
+        # The duplicated priorities make save() renumber the siblings
+        a.tn_priority = 1
+        a.save()
+        self.assertEqual(list(children), [b, a])
+        PlainNode.bulk_save_tree([(a.pk, root.pk, 0), (b.pk, root.pk, 1)])
+        self.assertEqual(list(children.all()), [a, b])
+
+
+class OrderTest(TestCase):
+
+    def setUp(self):
+        self.root = Node.objects.create(name='root')
+        self.other = Node.objects.create(name='other')
+        for parent, names in ((self.root, 'abcd'), (self.other, 'xy')):
+            for priority, name in enumerate(names):
+                setattr(self, name, Node.objects.create(
+                    name=name, tn_parent=parent, tn_priority=priority))
+
+    def get_children(self, parent):
+        return list(Node._base_manager.filter(
+            tn_parent=parent
+        ).order_by('tn_priority').values_list('name', 'tn_priority'))
+
+    def move(self, node, priority, parent=None):
+        node.refresh_from_db()
+        node.tn_parent = parent or node.tn_parent
+        node.tn_priority = priority
+        node.save()
+
+    def test_move_up(self):
+        self.move(self.d, 1)
+        self.assertEqual(self.get_children(self.root),
+                         [('a', 0), ('d', 1), ('b', 2), ('c', 3)])
+
+    def test_move_down(self):
+        self.move(self.a, 2)
+        self.assertEqual(self.get_children(self.root),
+                         [('b', 0), ('c', 1), ('a', 2), ('d', 3)])
+
+    def test_move_to_other_parent(self):
+        self.move(self.b, 1, parent=self.other)
+        self.assertEqual(self.get_children(self.root),
+                         [('a', 0), ('c', 1), ('d', 2)])
+        self.assertEqual(self.get_children(self.other),
+                         [('x', 0), ('b', 1), ('y', 2)])
+
+    def test_gapped_priorities(self):
+        for node, priority in zip((self.a, self.b, self.c, self.d),
+                                  (0, 5, 5, 9)):
+            Node._base_manager.filter(pk=node.pk).update(
+                tn_priority=priority)
+        self.move(self.c, 0)
+        self.assertEqual(self.get_children(self.root),
+                         [('c', 0), ('a', 1), ('b', 2), ('d', 3)])
+
+    def test_duplicated_priorities(self):
+        Node._base_manager.filter(tn_parent=self.root).update(tn_priority=0)
+        self.move(self.d, 1)
+        self.assertEqual(self.get_children(self.root),
+                         [('a', 0), ('d', 1), ('b', 2), ('c', 3)])
@@ -9,6 +9,7 @@ Email: kaduevtr@gmail.com
 
 """
 from django import forms
+from django.db.models import Max
 
 
 class TreeWidget(forms.Select):
@@ -28,16 +29,32 @@ class TreeWidget(forms.Select):
 
         )
 
+    def optgroups(self, name, value, attrs=None):
+        # Tree attributes of all options are read before they are rendered
+        self.tree_options = self.get_tree_options()
+        return super().optgroups(name, value, attrs)
+
+    def get_tree_options(self):
+        """Get parent, level and leaf flag of every node at once"""
+
+        model = self.choices.queryset.model
+        qs = model.closure_model.objects.order_by()
+        parents = dict(qs.filter(depth=1).values_list('child', 'parent'))
+        levels = dict(
+            qs.values_list('child').annotate(level=Max('depth') + 1))
+        branches = set(parents.values())
+        return {
+            pk: {
+                'parent': parents.get(pk, ''),
+                'level': level,
+                'leaf': pk not in branches,
+            }
+            for pk, level in levels.items()
+        }
+
     def create_option(self, name, value, *args, **kwargs):
         option = super().create_option(name, value, *args, **kwargs)
         if value:
-            # get icon instance
-
-            item = self.choices.queryset.get(pk=value.value)
-            if item.tn_parent:
-                option['parent'] = item.tn_parent.id
-            else:
-                option['parent'] = ''
-            option['level'] = item.level
-            option['leaf'] = item.is_leaf()
+            # A node without closure rows is rendered without tree attributes
+            option.update(self.tree_options.get(value.value, {}))
         return option